@@ -1,4 +1,23 @@
 TOKEN="token_is_here"
+# Extra bot tokens that share outbound reminder traffic (TOKEN still handles commands).
+# Each sender bot must be a member of the chats it sends to; empty => TOKEN sends everything.
+SENDER_TOKENS = []
+# Send budget per sender bot (messages/second)
+SENDER_RATE = 25
+
+# Max number of concurrent sends when a broadcast reminder fans out to many chats
+BROADCAST_CONCURRENCY = 20
+# Max sends per chat per tick (10s), sent one after another; chats are served
+# concurrently. Telegram allows about 20 messages/minute per group, i.e. ~3 per tick.
+GROUP_SEND_QUOTA = 3
+# When a group has this many sends waiting, its new fires are deferred to a later tick
+SEND_BACKLOG_LIMIT = 5000
+# A send failing with a temporary error (network, flood) is retried with backoff up to this many times
+SEND_MAX_ATTEMPTS = 10
+# Memory budget for full group records kept in RAM (bytes of JSON); colder groups are
+# written to disk and reloaded on demand
+GROUP_CACHE_BYTES = 64 * 1024 * 1024
+
 weekday_dict = {
     'Monday': 'Thứ Hai',
     'Tuesday': 'Thứ Ba',
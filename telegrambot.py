@@ -6,33 +6,38 @@ import datetime as dt
 import json
 import logging
 import os
+import random
 import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import timedelta
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 import pytz
-from telegram import Update, InputFile
+from telegram import Bot, Update, InputFile
+from telegram.error import BadRequest, Forbidden, InvalidToken, RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes
 
-from config_telegram import TOKEN, weekday_dict, weekday_data
+from config_telegram import (
+    TOKEN, SENDER_TOKENS, SENDER_RATE, BROADCAST_CONCURRENCY, GROUP_SEND_QUOTA, SEND_BACKLOG_LIMIT,
+    SEND_MAX_ATTEMPTS, GROUP_CACHE_BYTES, weekday_dict, weekday_data
+)
 
 TIME_FMT = "%Y-%m-%d %H:%M"
+# legacy single-file storage, migrated into DATA_DIR on first start
 DATA_FILE = "data.json"
+# one <chat_id>.json per group + index.json
+DATA_DIR = "data"
+INDEX_FILE = "index.json"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
 
-# groups schema:
-# groups[chat_id] = {
-#   "chat_id": int,
-#   "name": str,
-#   "settings": {"tz": "Asia/Ho_Chi_Minh", "enabled": True},
-#   "data": [
-#       {"id": int, "time_receive": str, "duration": int, "message": str, "enabled": True}
-#   ]
-# }
-groups: Dict[int, Dict[str, Any]] = {}
-data_lock = asyncio.Lock()
+# Concurrency: mutations of a group hold that group's lock (groups.lock(chat_id)), so
+# unrelated chats never wait on each other. Persistence takes save_lock only; it
+# serializes dirty groups synchronously (no await => consistent between two mutations)
+# and writes the files in a worker thread. Every mutation calls groups.mark_dirty().
+save_lock = asyncio.Lock()
 
 
 # -----------------------------
@@ -46,7 +51,10 @@ def ensure_group_defaults(group: Dict[str, Any]) -> None:
     group.setdefault("settings", {})
     group["settings"].setdefault("tz", "Asia/Ho_Chi_Minh")
     group["settings"].setdefault("enabled", True)
+    group["settings"].setdefault("broadcast_from", [])
+    group.setdefault("chat_sets", {})
     group.setdefault("data", [])
+    group.setdefault("outbox", [])
     # add enabled for existing reminders
     for m in group["data"]:
         m.setdefault("enabled", True)
@@ -89,42 +97,360 @@ def get_next_datetime_from_weekday(weekday_en: str, hour: int, minute: int, tz:
 # -----------------------------
 # Persistence (atomic write)
 # -----------------------------
-def _atomic_write_json(path: str, obj: Any) -> None:
+def _atomic_write_text(path: str, raw: str) -> None:
     tmp = f"{path}.tmp"
     with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False)
+        f.write(raw)
+        # group files double as the send journal (outbox): make them survive a crash
+        f.flush()
+        os.fsync(f.fileno())
     os.replace(tmp, path)
 
 
+def group_index_entry(group: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Compact, always-resident summary of a group:
+    next = earliest fire (UTC timestamp) among enabled reminders, 0 if the outbox has
+    pending sends, None if nothing will fire.
+    """
+    ensure_group_defaults(group)
+    nxt: Optional[float] = None
+    if group["outbox"]:
+        nxt = 0.0
+    elif group["settings"]["enabled"]:
+        tz = get_tz(group["settings"]["tz"])
+        for m in group["data"]:
+            try:
+                if not m.get("enabled", True):
+                    continue
+                ts = aware_from_timestr(m["time_receive"], tz).timestamp()
+                nxt = ts if nxt is None else min(nxt, ts)
+            except Exception:
+                pass
+    return {"next": nxt, "enabled": group["settings"]["enabled"], "outbox": len(group["outbox"]),
+            "broadcast_from": list(group["settings"]["broadcast_from"])}
+
+
+class GroupStore:
+    """
+    groups[chat_id] backed by one JSON file per group in DATA_DIR.
+
+    Only the index (see group_index_entry) is always in RAM. Full group records are
+    loaded on access and evicted least-recently-used once their JSON size passes
+    GROUP_CACHE_BYTES. Only groups that are saved and not locked are evicted, so a group
+    held under its lock (or with unsaved changes) always stays resident.
+
+    Code that mutates a group calls mark_dirty(chat_id) under the group's lock; only
+    dirty groups are serialized on save. Async code loads groups with fetch() under the
+    group's lock, so a cold group is read off the event loop.
+    """
+
+    def __init__(self, path: str, budget: int) -> None:
+        self.path = path
+        self.budget = budget
+        self.index: Dict[int, Dict[str, Any]] = {}
+        self._cache: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._sizes: Dict[int, int] = {}
+        # sum of _sizes, kept up to date so eviction checks are O(1)
+        self._resident = 0
+        # chat_id -> version of its latest unsaved change
+        self._dirty: Dict[int, int] = {}
+        self._version = 0
+        # index changed without a dirty group (load reconciliation, dropped group)
+        self._index_changed = False
+        # per-group locks and how many coroutines hold/wait on each; an unused lock of a
+        # non-resident group is dropped so locks do not outgrow the cache
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._lock_users: Dict[int, int] = {}
+
+    def _file(self, chat_id: int) -> str:
+        return os.path.join(self.path, f"{chat_id}.json")
+
+    @asynccontextmanager
+    async def lock(self, chat_id: int) -> AsyncIterator[None]:
+        lk = self._locks.get(chat_id)
+        if lk is None:
+            lk = self._locks[chat_id] = asyncio.Lock()
+        self._lock_users[chat_id] = self._lock_users.get(chat_id, 0) + 1
+        try:
+            async with lk:
+                yield
+        finally:
+            users = self._lock_users[chat_id] - 1
+            if users:
+                self._lock_users[chat_id] = users
+            else:
+                del self._lock_users[chat_id]
+                if chat_id not in self._cache:
+                    self._locks.pop(chat_id, None)
+
+    def __contains__(self, chat_id: int) -> bool:
+        return chat_id in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, chat_id: int) -> Dict[str, Any]:
+        group = self.get(chat_id)
+        if group is None:
+            raise KeyError(chat_id)
+        return group
+
+    def __setitem__(self, chat_id: int, group: Dict[str, Any]) -> None:
+        ensure_group_defaults(group)
+        self._cache[chat_id] = group
+        self._cache.move_to_end(chat_id)
+        self._set_size(chat_id, len(json.dumps(group, ensure_ascii=False)))
+        self.index[chat_id] = group_index_entry(group)
+        self.mark_dirty(chat_id)
+        self._evict()
+
+    def mark_dirty(self, chat_id: int) -> None:
+        self._version += 1
+        self._dirty[chat_id] = self._version
+
+    def get(self, chat_id: int, default: Any = None) -> Any:
+        """Synchronous: a cold group is read on the calling thread (load, migration)."""
+        if chat_id in self._cache:
+            self._cache.move_to_end(chat_id)
+            return self._cache[chat_id]
+        if chat_id not in self.index:
+            return default
+
+        # other OSErrors (EMFILE, EIO, EACCES) are transient: raised, the group is kept
+        try:
+            group, size = self._read(chat_id)
+        except (FileNotFoundError, ValueError) as e:
+            self._read_failed(chat_id, e)
+            return default
+        return self._install(chat_id, group, size)
+
+    async def fetch(self, chat_id: int, default: Any = None) -> Any:
+        """get() for the event loop: a cold group is read and parsed in a worker thread."""
+        if chat_id in self._cache or chat_id not in self.index:
+            return self.get(chat_id, default)
+
+        try:
+            group, size = await asyncio.get_running_loop().run_in_executor(None, self._read, chat_id)
+        except (FileNotFoundError, ValueError) as e:
+            if chat_id in self.index and chat_id not in self._cache:
+                self._read_failed(chat_id, e)
+            return self.get(chat_id, default)
+        # stored or dropped while reading: that wins over the file
+        if chat_id in self._cache or chat_id not in self.index:
+            return self.get(chat_id, default)
+        return self._install(chat_id, group, size)
+
+    def _read(self, chat_id: int) -> Tuple[Dict[str, Any], int]:
+        """File I/O and parsing only (safe to run in a worker thread)."""
+        with open(self._file(chat_id), "r", encoding="utf-8") as f:
+            raw = f.read()
+        return json.loads(raw), len(raw)
+
+    def _read_failed(self, chat_id: int, e: Exception) -> None:
+        # forget the group so `in` and get() agree
+        self.index.pop(chat_id, None)
+        self._index_changed = True
+        if isinstance(e, FileNotFoundError):
+            logging.error("Group file %s missing, dropped from index", chat_id)
+            return
+        # corrupt (JSONDecodeError, bad encoding): kept aside as .corrupt
+        logging.error("Group file %s corrupt, dropped from index: %s", chat_id, e)
+        try:
+            os.replace(self._file(chat_id), f"{self._file(chat_id)}.corrupt")
+        except OSError:
+            pass
+
+    def _install(self, chat_id: int, group: Dict[str, Any], size: int) -> Dict[str, Any]:
+        group["chat_id"] = int(chat_id)
+        ensure_group_defaults(group)
+        self._cache[chat_id] = group
+        self._set_size(chat_id, size)
+        self._evict()
+        return group
+
+    def _set_size(self, chat_id: int, size: int) -> None:
+        self._resident += size - self._sizes.get(chat_id, 0)
+        self._sizes[chat_id] = size
+
+    def _evict(self) -> None:
+        if self._resident <= self.budget:
+            return
+        # LRU first; never the group that was just accessed
+        for cid in list(self._cache)[:-1]:
+            if self._resident <= self.budget:
+                break
+            # locked, or unsaved changes: evictable after the next save
+            if self._lock_users.get(cid) or cid in self._dirty:
+                continue
+            self._cache.pop(cid)
+            self._locks.pop(cid, None)
+            self._resident -= self._sizes.pop(cid, 0)
+
+    def snapshot(self) -> Tuple[List[Tuple[int, str, int]], Optional[Dict[int, Dict[str, Any]]]]:
+        """
+        Serialize dirty groups: ([(chat_id, json, version)], index copy or None if unchanged).
+        Synchronous, so every group is seen between two mutations without its lock.
+        Index entries are replaced, never mutated, so a shallow copy is a stable snapshot.
+        """
+        writes: List[Tuple[int, str, int]] = []
+        for cid, version in self._dirty.items():
+            group = self._cache.get(cid)
+            if group is None:
+                continue
+            raw = json.dumps(group, ensure_ascii=False)
+            self.index[cid] = group_index_entry(group)
+            self._set_size(cid, len(raw))
+            writes.append((cid, raw, version))
+        index = dict(self.index) if writes or self._index_changed else None
+        self._index_changed = False
+        return writes, index
+
+    def write(self, writes: List[Tuple[int, str, int]], index: Optional[Dict[int, Dict[str, Any]]]) -> None:
+        """File I/O (safe to run in a worker thread): groups first, then the index."""
+        os.makedirs(self.path, exist_ok=True)
+        for cid, raw, _ in writes:
+            _atomic_write_text(self._file(cid), raw)
+        if index is not None:
+            index_raw = json.dumps({str(cid): entry for cid, entry in index.items()}, ensure_ascii=False)
+            _atomic_write_text(os.path.join(self.path, INDEX_FILE), index_raw)
+
+    def mark_written(self, writes: List[Tuple[int, str, int]]) -> None:
+        for cid, _, version in writes:
+            # changed again since the snapshot: stays dirty
+            if self._dirty.get(cid) == version:
+                del self._dirty[cid]
+        self._evict()
+
+    def save(self) -> int:
+        """Synchronous snapshot + write. Returns the number of groups written."""
+        writes, index = self.snapshot()
+        self.write(writes, index)
+        self.mark_written(writes)
+        return len(writes)
+
+    def load(self) -> None:
+        """
+        Read the index; groups are loaded lazily. Group files written after the index
+        (a crash between the two writes) or missing from it are re-read to fix their entry;
+        an unreadable index is rebuilt from all group files.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        self.index.clear()
+        self._cache.clear()
+        self._sizes.clear()
+        self._resident = 0
+        self._dirty.clear()
+        self._locks.clear()
+        self._lock_users.clear()
+
+        index_path = os.path.join(self.path, INDEX_FILE)
+        index_mtime = -1
+        if os.path.exists(index_path):
+            try:
+                index_mtime = os.stat(index_path).st_mtime_ns
+                with open(index_path, "r", encoding="utf-8") as f:
+                    self.index = {int(cid): entry for cid, entry in json.load(f).items()}
+            except (OSError, ValueError, AttributeError) as e:
+                logging.error("Index unreadable, rebuilding from group files: %s", e)
+                self.index = {}
+                index_mtime = -1
+
+        # only stat()s here; a group file is parsed only if its entry may be stale
+        reconciled = 0
+        with os.scandir(self.path) as it:
+            for ent in it:
+                stem, ext = os.path.splitext(ent.name)
+                if ext != ".json" or ent.name == INDEX_FILE:
+                    continue
+                try:
+                    cid = int(stem)
+                except ValueError:
+                    continue
+                if cid in self.index and ent.stat().st_mtime_ns < index_mtime:
+                    continue
+                self.index.setdefault(cid, {"next": 0.0, "enabled": True, "outbox": 0, "broadcast_from": []})
+                try:
+                    group = self.get(cid)
+                except OSError as e:
+                    # transient: keep the entry (a new one is due right away), retried later
+                    logging.error("Group file %s unreadable: %s", cid, e)
+                    continue
+                if group is not None:
+                    self.index[cid] = group_index_entry(group)
+                    reconciled += 1
+        if reconciled:
+            self._index_changed = True
+            logging.warning("Reconciled %d index entries from group files", reconciled)
+
+    def due_ids(self, now_ts: float) -> List[int]:
+        return [cid for cid, e in self.index.items() if e["next"] is not None and e["next"] <= now_ts]
+
+    def outbox_ids(self) -> List[int]:
+        return [cid for cid, e in self.index.items() if e["outbox"]]
+
+    def accepts_broadcast(self, target_id: int, owner_id: int) -> bool:
+        """Target is registered, not paused, and is the owner itself or opted in to it."""
+        e = self.index.get(target_id)
+        if not e or not e["enabled"]:
+            return False
+        return target_id == owner_id or owner_id in e.get("broadcast_from", [])
+
+
+# groups schema:
+# groups[chat_id] = {
+#   "chat_id": int,
+#   "name": str,
+#   "settings": {"tz": "Asia/Ho_Chi_Minh", "enabled": True,
+#                # owner chats allowed to broadcast into this chat (opt-in)
+#                "broadcast_from": [chat_id, ...]},
+#   "chat_sets": {"name": [chat_id, ...]},
+#   "data": [
+#       {"id": int, "time_receive": str, "duration": int, "message": str, "enabled": True,
+#        # optional, broadcast reminders only (one of targets/chat_set):
+#        "targets": [chat_id, ...], "chat_set": str,
+#        "delivery": {"<chat_id>": {"status": "pending|sent|failed|skipped", "at": str, "error": str}}}
+#   ],
+#   # fired but not yet sent (write-ahead journal, drained by send_due_messages)
+#   "outbox": [{"id": int, "chat_id": int, "text": str, "at": str, "broadcast": bool,
+#               # after a temporary failure:
+#               "attempts": int, "retry_at": float}]
+# }
+groups = GroupStore(DATA_DIR, GROUP_CACHE_BYTES)
+
+
 async def save_data() -> None:
-    async with data_lock:
-        payload = list(groups.values())
-        _atomic_write_json(DATA_FILE, payload)
-        logging.info("Saved %d groups", len(payload))
+    async with save_lock:
+        writes, index = groups.snapshot()
+        if not writes and index is None:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, groups.write, writes, index)
+        groups.mark_written(writes)
+        logging.info("Saved %d/%d groups", len(writes), len(groups))
+
+
+def migrate_legacy_data() -> None:
+    """data.json (list of groups) -> DATA_DIR, once. data.json is kept as data.json.bak."""
+    with open(DATA_FILE, "r", encoding="utf-8") as f:
+        payload = json.load(f)
+    for g in payload:
+        cid = int(g["chat_id"])
+        g["chat_id"] = cid
+        groups[cid] = g
+    groups.save()
+    os.replace(DATA_FILE, f"{DATA_FILE}.bak")
+    logging.info("Migrated %d groups from %s to %s/", len(payload), DATA_FILE, DATA_DIR)
 
 
 async def load_data() -> None:
-    global groups
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            payload = json.load(f)
-        new_groups: Dict[int, Dict[str, Any]] = {}
-        for g in payload:
-            cid = int(g["chat_id"])
-            g["chat_id"] = cid
-            ensure_group_defaults(g)
-            new_groups[cid] = g
-        async with data_lock:
-            groups = new_groups
-        logging.info("Loaded %d groups", len(groups))
-    except FileNotFoundError:
-        logging.warning("No data.json found. Start fresh.")
-        async with data_lock:
-            groups = {}
-    except Exception as e:
-        logging.exception("Load error: %s", e)
-        async with data_lock:
-            groups = {}
+    async with save_lock:
+        try:
+            groups.load()
+            if not len(groups) and os.path.exists(DATA_FILE):
+                migrate_legacy_data()
+            logging.info("Loaded index of %d groups", len(groups))
+        except Exception as e:
+            logging.exception("Load error: %s", e)
 
 
 # -----------------------------
@@ -177,6 +503,38 @@ def validate_list_week(value: Any) -> Optional[List[str]]:
         return None
 
 
+def validate_chat_ids(value: Any) -> Optional[List[int]]:
+    """
+    Accept a non-empty list of chat ids (int or numeric str).
+    Duplicates are dropped, order is kept.
+    """
+    try:
+        if not isinstance(value, list) or not value:
+            return None
+        out: List[int] = []
+        for v in value:
+            if isinstance(v, bool):
+                return None
+            cid = int(v)
+            if cid not in out:
+                out.append(cid)
+        return out
+    except Exception:
+        return None
+
+
+def get_recipients(group: Dict[str, Any], m: Dict[str, Any]) -> Optional[List[int]]:
+    """
+    Target chats of a broadcast reminder, None for a normal (single chat) reminder.
+    chat_set is resolved at fire time so edits to the set apply to existing reminders.
+    """
+    if m.get("targets"):
+        return [int(c) for c in m["targets"]]
+    if m.get("chat_set"):
+        return [int(c) for c in group.get("chat_sets", {}).get(m["chat_set"], [])]
+    return None
+
+
 def get_next_id(group: Dict[str, Any]) -> int:
     max_id = 0
     for m in group.get("data", []):
@@ -205,6 +563,44 @@ async def is_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
         return False
 
 
+async def is_chat_admin(bot: Bot, chat_id: int, user_id: int) -> bool:
+    """Is user_id an admin of chat_id (a private chat counts only for its own user)."""
+    if chat_id == user_id:
+        return True
+    if chat_id > 0:
+        return False
+    try:
+        admins = await bot.get_chat_administrators(chat_id)
+        return any(a.user.id == user_id for a in admins)
+    except Exception:
+        return False
+
+
+async def authorize_targets(bot: Bot, owner_id: int, user_id: int, targets: List[int]) -> List[int]:
+    """
+    Broadcast targets of owner_id that are not allowed; empty list => all allowed.
+    A target is allowed if it already opted in to owner_id (/allow_broadcast), or if
+    user_id is admin there, in which case the opt-in is recorded on the target.
+    """
+    denied: List[int] = []
+    for cid in targets:
+        if cid == owner_id or groups.accepts_broadcast(cid, owner_id):
+            continue
+        if cid not in groups or not await is_chat_admin(bot, cid, user_id):
+            denied.append(cid)
+            continue
+        async with groups.lock(cid):
+            g = await groups.fetch(cid)
+            if not g:
+                denied.append(cid)
+                continue
+            ensure_group_defaults(g)
+            if owner_id not in g["settings"]["broadcast_from"]:
+                g["settings"]["broadcast_from"].append(owner_id)
+                groups.mark_dirty(cid)
+    return denied
+
+
 async def require_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     ok = await is_admin(update, context)
     if not ok:
@@ -223,8 +619,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = int(chat.id)
     title = getattr(chat, "title", None) or "private"
 
-    async with data_lock:
-        if chat_id not in groups:
+    async with groups.lock(chat_id):
+        group = await groups.fetch(chat_id)
+        if not group:
             groups[chat_id] = {
                 "chat_id": chat_id,
                 "name": title,
@@ -232,13 +629,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 "data": []
             }
         else:
-            groups[chat_id]["name"] = title
-            ensure_group_defaults(groups[chat_id])
+            group["name"] = title
+            ensure_group_defaults(group)
+            groups.mark_dirty(chat_id)
 
     # ensure job exists
-    exists = any(j.name == "auto_send" for j in context.job_queue.jobs())
-    if not exists:
-        context.job_queue.run_repeating(send_due_messages, name="auto_send", interval=10, first=0)
+    ensure_send_job(context.job_queue)
 
     await save_data()
 
@@ -254,7 +650,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "- /pause_all | /resume_all\n"
         "- /snooze {\"id\":1,\"minutes\":15}\n"
         "- /set_timezone {\"tz\":\"Asia/Bangkok\"}\n"
-        "- /export\n"
+        "- /export\n\n"
+        "Broadcast:\n"
+        "- /set_chat_set {\"name\":\"chi_nhanh\",\"chat_ids\":[-1001,-1002]}\n"
+        "- /set_message {...,\"chat_set\":\"chi_nhanh\"} hoặc {...,\"targets\":[-1001,-1002]}\n"
+        "- /broadcast_status {\"id\":1}\n"
+        "- /allow_broadcast {\"chat_id\":-1001} | /deny_broadcast {\"chat_id\":-1001}\n"
     )
     await update.message.reply_text(msg)
 
@@ -275,24 +676,59 @@ async def set_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         if duration is None or time_receive is None:
             raise ValueError("Invalid duration/time_receive")
 
-        async with data_lock:
-            if chat_id not in groups:
+        targets = None
+        if payload.get("targets") is not None:
+            targets = validate_chat_ids(payload.get("targets"))
+            if targets is None:
+                raise ValueError("Invalid targets")
+        chat_set = payload.get("chat_set")
+        if chat_set is not None and (not isinstance(chat_set, str) or not chat_set):
+            raise ValueError("Invalid chat_set")
+        if targets is not None and chat_set is not None:
+            raise ValueError("targets and chat_set are exclusive")
+
+        if targets is not None:
+            denied = await authorize_targets(context.bot, chat_id, update.effective_user.id, targets)
+            if denied:
+                await update.message.reply_text(
+                    f"Không có quyền broadcast tới: {', '.join(map(str, denied))}\n"
+                    "Bạn cần là admin của chat đó, hoặc admin chat đó dùng /allow_broadcast"
+                )
+                return
+
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
+            if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng nhập /start để bắt đầu")
                 return
 
-            group = groups[chat_id]
             ensure_group_defaults(group)
 
+            if chat_set is not None and chat_set not in group["chat_sets"]:
+                await update.message.reply_text(f"Không tìm thấy chat_set: {chat_set}")
+                return
+
+            def _apply_targets(m: Dict[str, Any]) -> None:
+                m.pop("targets", None)
+                m.pop("chat_set", None)
+                if targets is not None:
+                    m["targets"] = targets
+                elif chat_set is not None:
+                    m["chat_set"] = chat_set
+
             if msg_id is None:
                 new_id = get_next_id(group)
-                group["data"].append({
+                new_msg = {
                     "id": new_id,
                     "time_receive": time_receive,
                     "duration": duration,
                     "message": text,
                     "enabled": True
-                })
+                }
+                _apply_targets(new_msg)
+                group["data"].append(new_msg)
                 reply = f"Đã thêm nhắc nhở (ID={new_id})"
+                groups.mark_dirty(chat_id)
             else:
                 msg_id = int(msg_id)
                 found = False
@@ -301,7 +737,9 @@ async def set_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                         m["time_receive"] = time_receive
                         m["duration"] = duration
                         m["message"] = text
+                        _apply_targets(m)
                         found = True
+                        groups.mark_dirty(chat_id)
                         break
                 reply = "Đã cập nhật nhắc nhở" if found else "Không tồn tại id này"
 
@@ -332,12 +770,12 @@ async def set_message_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         hhmm = dt.datetime.strptime(time_hm, "%H:%M")
         hour, minute = hhmm.hour, hhmm.minute
 
-        async with data_lock:
-            if chat_id not in groups:
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
+            if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng nhập /start để bắt đầu")
                 return
 
-            group = groups[chat_id]
             ensure_group_defaults(group)
             tz = get_tz(group["settings"]["tz"])
 
@@ -352,6 +790,7 @@ async def set_message_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -
                     "message": text,
                     "enabled": True
                 })
+            groups.mark_dirty(chat_id)
 
         await save_data()
         await update.message.reply_text("Đã thêm nhắc nhở theo tuần")
@@ -364,8 +803,8 @@ async def set_message_week(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def get_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = int(update.effective_chat.id)
 
-    async with data_lock:
-        group = groups.get(chat_id)
+    async with groups.lock(chat_id):
+        group = await groups.fetch(chat_id)
         if not group:
             await update.message.reply_text("Không tìm thấy nhóm này, vui lòng nhập /start để bắt đầu")
             return
@@ -374,12 +813,13 @@ async def get_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         tz_name = group["settings"]["tz"]
         enabled_all = group["settings"]["enabled"]
 
-        data = list(group["data"])
-        # sort by time_receive
-        def _key(m: Dict[str, Any]) -> Tuple[int, str]:
-            # enabled first, then time
-            return (0 if m.get("enabled", True) else 1, m.get("time_receive", "9999-99-99 99:99"))
-        data.sort(key=_key)
+        data = [dict(m) for m in group["data"]]
+
+    # sort by time_receive (outside the lock, on a copy)
+    def _key(m: Dict[str, Any]) -> Tuple[int, str]:
+        # enabled first, then time
+        return (0 if m.get("enabled", True) else 1, m.get("time_receive", "9999-99-99 99:99"))
+    data.sort(key=_key)
 
     if not data:
         await update.message.reply_text(f"Chưa có nhắc nhở nào.\nTimezone: {tz_name}\nGroup enabled: {enabled_all}")
@@ -396,6 +836,10 @@ async def get_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         lines.append(f"ID: {m['id']} | Enabled: {m.get('enabled', True)}")
         lines.append(f"Thời gian nhận: {format_vn_day(m['time_receive'])}")
         lines.append(f"Chu kỳ: {m['duration']} ngày")
+        if m.get("targets"):
+            lines.append(f"Broadcast: {len(m['targets'])} chat")
+        elif m.get("chat_set"):
+            lines.append(f"Broadcast: chat_set {m['chat_set']}")
         lines.append(f"Nội dung: {m.get('message','')}")
         lines.append("*" * 20)
 
@@ -415,8 +859,8 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
         target_id = int(payload["id"])
 
-        async with data_lock:
-            group = groups.get(chat_id)
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
             if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng nhập /start để bắt đầu")
                 return
@@ -425,6 +869,8 @@ async def delete_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             before = len(group["data"])
             group["data"] = [m for m in group["data"] if int(m.get("id", -1)) != target_id]
             after = len(group["data"])
+            if after < before:
+                groups.mark_dirty(chat_id)
 
         await save_data()
         await update.message.reply_text("Đã xóa nhắc nhở" if after < before else "Không tìm thấy id")
@@ -447,8 +893,8 @@ async def pause(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
         target_id = int(payload["id"])
 
-        async with data_lock:
-            group = groups.get(chat_id)
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
             if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
                 return
@@ -459,6 +905,7 @@ async def pause(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 if int(m.get("id")) == target_id:
                     m["enabled"] = False
                     found = True
+                    groups.mark_dirty(chat_id)
                     break
 
         if found:
@@ -484,8 +931,8 @@ async def resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             return
         target_id = int(payload["id"])
 
-        async with data_lock:
-            group = groups.get(chat_id)
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
             if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
                 return
@@ -496,6 +943,7 @@ async def resume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                 if int(m.get("id")) == target_id:
                     m["enabled"] = True
                     found = True
+                    groups.mark_dirty(chat_id)
                     break
 
         if found:
@@ -526,8 +974,8 @@ async def snooze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             await update.message.reply_text("minutes phải > 0")
             return
 
-        async with data_lock:
-            group = groups.get(chat_id)
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
             if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
                 return
@@ -543,6 +991,7 @@ async def snooze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
                     m["time_receive"] = new_time.strftime(TIME_FMT)
                     m["enabled"] = True
                     found = True
+                    groups.mark_dirty(chat_id)
                     break
 
         if found:
@@ -561,13 +1010,14 @@ async def pause_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
     chat_id = int(update.effective_chat.id)
 
-    async with data_lock:
-        group = groups.get(chat_id)
+    async with groups.lock(chat_id):
+        group = await groups.fetch(chat_id)
         if not group:
             await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
             return
         ensure_group_defaults(group)
         group["settings"]["enabled"] = False
+        groups.mark_dirty(chat_id)
 
     await save_data()
     await update.message.reply_text("Đã tạm dừng toàn bộ nhắc nhở trong group")
@@ -578,18 +1028,155 @@ async def resume_all(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
     chat_id = int(update.effective_chat.id)
 
-    async with data_lock:
-        group = groups.get(chat_id)
+    async with groups.lock(chat_id):
+        group = await groups.fetch(chat_id)
         if not group:
             await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
             return
         ensure_group_defaults(group)
         group["settings"]["enabled"] = True
+        groups.mark_dirty(chat_id)
 
     await save_data()
     await update.message.reply_text("Đã bật lại toàn bộ nhắc nhở trong group")
 
 
+# -------- New: broadcast (chat sets & delivery status) --------
+async def set_chat_set(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not await require_admin(update, context):
+        return
+
+    chat_id = int(update.effective_chat.id)
+    try:
+        payload = parse_json_from_command(update.message.text, "/set_chat_set")
+        name = payload.get("name")
+        if not isinstance(name, str) or not name:
+            await update.message.reply_text("Cần {\"name\":\"...\",\"chat_ids\":[...]}")
+            return
+
+        # empty list => delete the set
+        raw_ids = payload.get("chat_ids")
+        chat_ids = [] if raw_ids == [] else validate_chat_ids(raw_ids)
+        if chat_ids is None:
+            raise ValueError("Invalid chat_ids")
+
+        denied = await authorize_targets(context.bot, chat_id, update.effective_user.id, chat_ids)
+        if denied:
+            await update.message.reply_text(
+                f"Không có quyền broadcast tới: {', '.join(map(str, denied))}\n"
+                "Bạn cần là admin của chat đó, hoặc admin chat đó dùng /allow_broadcast"
+            )
+            return
+
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
+            if not group:
+                await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
+                return
+            ensure_group_defaults(group)
+
+            if chat_ids:
+                group["chat_sets"][name] = chat_ids
+                reply = f"Đã lưu chat_set {name} ({len(chat_ids)} chat)"
+            else:
+                group["chat_sets"].pop(name, None)
+                reply = f"Đã xóa chat_set {name}"
+            groups.mark_dirty(chat_id)
+
+        await save_data()
+        await update.message.reply_text(reply)
+
+    except Exception as e:
+        logging.info("set_chat_set error: %s", e)
+        await update.message.reply_text("Sai định dạng, vui lòng nhập lại")
+
+
+async def _set_broadcast_from(update: Update, context: ContextTypes.DEFAULT_TYPE, command: str, allow: bool) -> None:
+    if not await require_admin(update, context):
+        return
+
+    chat_id = int(update.effective_chat.id)
+    try:
+        payload = parse_json_from_command(update.message.text, command)
+        if payload.get("chat_id") is None:
+            await update.message.reply_text("Cần {\"chat_id\":...} của nhóm gửi broadcast")
+            return
+        owner_id = int(payload["chat_id"])
+
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
+            if not group:
+                await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
+                return
+            ensure_group_defaults(group)
+
+            allowed = group["settings"]["broadcast_from"]
+            if allow and owner_id not in allowed:
+                allowed.append(owner_id)
+            elif not allow and owner_id in allowed:
+                allowed.remove(owner_id)
+            groups.mark_dirty(chat_id)
+
+        await save_data()
+        if allow:
+            await update.message.reply_text(f"Đã cho phép {owner_id} broadcast vào chat này")
+        else:
+            await update.message.reply_text(f"Đã chặn broadcast từ {owner_id}")
+
+    except Exception as e:
+        logging.info("%s error: %s", command, e)
+        await update.message.reply_text("Sai định dạng, vui lòng nhập lại")
+
+
+async def allow_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _set_broadcast_from(update, context, "/allow_broadcast", True)
+
+
+async def deny_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _set_broadcast_from(update, context, "/deny_broadcast", False)
+
+
+async def broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = int(update.effective_chat.id)
+    try:
+        payload = parse_json_from_command(update.message.text, "/broadcast_status")
+        if payload.get("id") is None:
+            await update.message.reply_text("Thiếu id")
+            return
+        target_id = int(payload["id"])
+
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
+            if not group:
+                await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
+                return
+            ensure_group_defaults(group)
+
+            msg = next((m for m in group["data"] if int(m.get("id", -1)) == target_id), None)
+            delivery = dict(msg.get("delivery", {})) if msg else {}
+
+        if msg is None:
+            await update.message.reply_text("Không tìm thấy id")
+            return
+        if not delivery:
+            await update.message.reply_text("Chưa có lần gửi broadcast nào cho nhắc nhở này")
+            return
+
+        counts: Dict[str, int] = {}
+        for st in delivery.values():
+            counts[st["status"]] = counts.get(st["status"], 0) + 1
+        lines = [f"Broadcast ID {target_id}: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items()))]
+        for cid, st in delivery.items():
+            if st["status"] != "sent":
+                lines.append(f"- {cid}: {st['status']} ({st.get('error', '')})")
+
+        await update.message.reply_text("\n".join(lines))
+
+    except Exception as e:
+        logging.info("broadcast_status error: %s", e)
+        await update.message.reply_text("Sai định dạng, vui lòng nhập lại")
+
+
 # -------- New: timezone per group --------
 async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await require_admin(update, context):
@@ -610,13 +1197,14 @@ async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await update.message.reply_text("Timezone không hợp lệ. Ví dụ: Asia/Ho_Chi_Minh, Asia/Bangkok, Asia/Tokyo")
             return
 
-        async with data_lock:
-            group = groups.get(chat_id)
+        async with groups.lock(chat_id):
+            group = await groups.fetch(chat_id)
             if not group:
                 await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
                 return
             ensure_group_defaults(group)
             group["settings"]["tz"] = tz_name
+            groups.mark_dirty(chat_id)
 
         await save_data()
         await update.message.reply_text(f"Đã cập nhật timezone: {tz_name}")
@@ -632,92 +1220,514 @@ async def export_data(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     chat_id = int(update.effective_chat.id)
-    async with data_lock:
-        group = groups.get(chat_id)
+    async with groups.lock(chat_id):
+        group = await groups.fetch(chat_id)
         if not group:
             await update.message.reply_text("Không tìm thấy nhóm này, vui lòng /start")
             return
         ensure_group_defaults(group)
-        payload = group
+        raw = json.dumps(group, ensure_ascii=False, indent=2).encode("utf-8")
 
-    raw = json.dumps(payload, ensure_ascii=False, indent=2).encode("utf-8")
     bio = BytesIO(raw)
     bio.name = f"data_export_{chat_id}.json"
     await update.message.reply_document(document=InputFile(bio), caption="Backup dữ liệu nhắc nhở của group này.")
 
 
+# -----------------------------
+# Sender pool (SENDER_TOKENS)
+# -----------------------------
+# Reminder traffic is spread over the sender bots. A chat sticks to one sender; new chats
+# are assigned weighted by each sender's remaining budget (token bucket of SENDER_RATE/s).
+# A sender hit by RetryAfter cools down, a revoked one (InvalidToken) is dropped, and a
+# sender that is not in the chat (Forbidden / "chat not found") is excluded for that chat
+# for SENDER_EXCLUDE_SECONDS, so unreachable chats are not probed on every send. When no
+# sender is usable the primary bot (TOKEN) sends, under its own token bucket (index -1).
+sender_bots: List[Bot] = []
+# per sender: {"budget": float, "updated": float, "cooldown_until": float, "dead": bool}
+sender_state: List[Dict[str, Any]] = []
+primary_state: Dict[str, Any] = {"budget": float(SENDER_RATE), "updated": time.monotonic()}
+PRIMARY_SENDER = -1
+# chat_id -> index in sender_bots
+sender_routes: Dict[int, int] = {}
+# chat_id -> {sender index: monotonic time until which it is known not to reach the chat}
+sender_excluded: Dict[int, Dict[int, float]] = {}
+SENDER_EXCLUDE_SECONDS = 24 * 3600
+
+
+async def init_senders() -> None:
+    for token in SENDER_TOKENS:
+        bot = Bot(token)
+        try:
+            await bot.initialize()
+        except Exception as e:
+            logging.error("Sender bot disabled (init failed): %s", e)
+            continue
+        sender_bots.append(bot)
+        sender_state.append({"budget": float(SENDER_RATE), "updated": time.monotonic(),
+                             "cooldown_until": 0.0, "dead": False})
+    if sender_bots:
+        logging.info("Sender pool: %d bots", len(sender_bots))
+
+
+async def shutdown_senders() -> None:
+    for bot in sender_bots:
+        try:
+            await bot.shutdown()
+        except Exception as e:
+            logging.info("Sender shutdown error: %s", e)
+
+
+def _refill(st: Dict[str, Any]) -> None:
+    now = time.monotonic()
+    st["budget"] = min(float(SENDER_RATE), st["budget"] + (now - st["updated"]) * SENDER_RATE)
+    st["updated"] = now
+
+
+def is_not_member(e: Exception) -> bool:
+    """The bot cannot reach this chat (kicked, blocked or never added)."""
+    return isinstance(e, Forbidden) or (isinstance(e, BadRequest) and "chat not found" in str(e).lower())
+
+
+def exclude_sender(chat_id: int, idx: int) -> None:
+    sender_excluded.setdefault(chat_id, {})[idx] = time.monotonic() + SENDER_EXCLUDE_SECONDS
+    if sender_routes.get(chat_id) == idx:
+        del sender_routes[chat_id]
+
+
+def pick_sender(chat_id: int, tried: set) -> Optional[int]:
+    now = time.monotonic()
+    excluded = sender_excluded.get(chat_id)
+    if excluded:
+        for i in [i for i, until in excluded.items() if until <= now]:
+            del excluded[i]
+        if not excluded:
+            del sender_excluded[chat_id]
+
+    usable = [i for i, st in enumerate(sender_state)
+              if i not in tried and not st["dead"] and st["cooldown_until"] <= now
+              and not (excluded and i in excluded)]
+    if not usable:
+        return None
+
+    idx = sender_routes.get(chat_id)
+    if idx in usable:
+        return idx
+    if idx is not None and not sender_state[idx]["dead"] and not (excluded and idx in excluded):
+        # sticky sender is only cooling down: use another one meanwhile, keep the route
+        return random.choice(usable)
+
+    for i in usable:
+        _refill(sender_state[i])
+    weights = [max(sender_state[i]["budget"], 0.0) + 0.01 for i in usable]
+    idx = random.choices(usable, weights=weights)[0]
+    sender_routes[chat_id] = idx
+    return idx
+
+
+async def take_budget(idx: int) -> None:
+    # reserve first, then wait: concurrent senders queue up behind a negative budget
+    st = primary_state if idx == PRIMARY_SENDER else sender_state[idx]
+    _refill(st)
+    st["budget"] -= 1
+    if st["budget"] < 0:
+        await asyncio.sleep(-st["budget"] / SENDER_RATE)
+
+
 # -----------------------------
 # Job: send due reminders
 # -----------------------------
-async def send_due_messages(context: ContextTypes.DEFAULT_TYPE) -> None:
-    # snapshot to reduce lock duration
-    async with data_lock:
-        snapshot = [(cid, dict(g)) for cid, g in groups.items()]
+# Due reminders are first moved into their group's "outbox" and rescheduled, and that
+# state is saved BEFORE anything is sent (write-ahead). Sends are then drained from the
+# outbox. A kill mid-tick therefore never loses a fire: unsent entries are still in
+# the group files and drained right after restart. Finished sends are appended to a small
+# journal (OUTBOX_JOURNAL) every OUTBOX_JOURNAL_EVERY sends instead of rewriting the group
+# files; the groups are saved once at the end of the drain and the journal dropped. On
+# startup the journal is replayed, so a kill re-sends at most the OUTBOX_JOURNAL_EVERY
+# unjournaled sends plus the up to BROADCAST_CONCURRENCY sends that were in flight.
+# A send that fails with a temporary error stays in the outbox and is retried with
+# backoff (up to SEND_MAX_ATTEMPTS); permanent errors (Forbidden, BadRequest) drop it.
+#
+# Fairness: each tick moves at most GROUP_SEND_QUOTA reminders per group into the outbox
+# (oldest first) and sends at most GROUP_SEND_QUOTA entries per destination chat. A chat's
+# entries go out one after another; different chats are served concurrently, starting
+# from a rotating offset. RetryAfter never sleeps inside the pool: the entry is requeued
+# for when Telegram allows it and the rest of that chat waits for a later tick. Once a
+# group has SEND_BACKLOG_LIMIT entries waiting in its own outbox, its new fires stay due
+# (deferred) until that outbox drains; other groups keep firing.
+
+# set False on shutdown: no new reminders are moved to the outbox
+accepting_fires = True
+# held for a whole send_due_messages run; shutdown waits on it to finish in-flight sends
+sender_lock = asyncio.Lock()
+# round-robin start offset, rotated every tick so no chat is always served first
+rr_offset = 0
+# finished outbox entries not yet saved in their group file, one JSON line each
+OUTBOX_JOURNAL = os.path.join(DATA_DIR, "outbox.journal")
+OUTBOX_JOURNAL_EVERY = 10
+
+
+def rotate(items: List[Any], offset: int) -> List[Any]:
+    if not items:
+        return items
+    k = offset % len(items)
+    return items[k:] + items[:k]
+
+
+def outbox_key(entry: Dict[str, Any]) -> Tuple[int, int, str]:
+    return int(entry["id"]), int(entry["chat_id"]), entry["at"]
+
+
+def append_journal(lines: List[str]) -> None:
+    with open(OUTBOX_JOURNAL, "a", encoding="utf-8") as f:
+        f.write("".join(lines))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def clear_journal() -> None:
+    try:
+        os.remove(OUTBOX_JOURNAL)
+    except FileNotFoundError:
+        pass
+
+
+def retry_seconds(e: RetryAfter) -> float:
+    delay = e.retry_after
+    if isinstance(delay, timedelta):
+        delay = delay.total_seconds()
+    return float(delay)
 
-    changed = False
 
-    for chat_id, g in snapshot:
+async def send_routed(primary: Bot, chat_id: int, text: str) -> None:
+    """Send through the sender pool, failing over between senders, then to the primary bot."""
+    tried: set = set()
+    while True:
+        idx = pick_sender(chat_id, tried)
+        if idx is None:
+            await take_budget(PRIMARY_SENDER)
+            await primary.send_message(chat_id=chat_id, text=text)
+            return
+
+        await take_budget(idx)
         try:
-            ensure_group_defaults(g)
-            if not g["settings"]["enabled"]:
+            await sender_bots[idx].send_message(chat_id=chat_id, text=text)
+            return
+        except RetryAfter as e:
+            delay = retry_seconds(e)
+            sender_state[idx]["cooldown_until"] = time.monotonic() + delay
+            logging.warning("Sender %d flood-limited for %ss", idx, delay)
+        except InvalidToken as e:
+            sender_state[idx]["dead"] = True
+            sender_routes.pop(chat_id, None)
+            logging.error("Sender %d token revoked: %s", idx, e)
+        except (Forbidden, BadRequest) as e:
+            if not is_not_member(e):
+                raise
+            # this sender is not in the chat: remember it, another one may be
+            exclude_sender(chat_id, idx)
+        tried.add(idx)
+
+
+def enqueue_due(chat_id: int, group: Dict[str, Any], limit: int) -> int:
+    """
+    Move due reminders of one group into its outbox and reschedule them, oldest first,
+    at most GROUP_SEND_QUOTA reminders and (about) limit outbox entries.
+    Caller holds the group's lock. Returns the number of outbox entries added.
+    """
+    ensure_group_defaults(group)
+    if not group["settings"]["enabled"]:
+        return 0
+
+    tz = get_tz(group["settings"]["tz"])
+    now = dt.datetime.now(tz)
+    fired_at = timestr_from_aware(now, tz)
+
+    due: List[Tuple[dt.datetime, Dict[str, Any]]] = []
+    for m in group["data"]:
+        try:
+            if not m.get("enabled", True):
                 continue
+            due_time = aware_from_timestr(m["time_receive"], tz)
+            if due_time <= now:
+                due.append((due_time, m))
+        except Exception as e:
+            logging.info("enqueue error: %s", e)
+    due.sort(key=lambda x: x[0])
+    if due:
+        groups.mark_dirty(chat_id)
+
+    before = len(group["outbox"])
+    for due_time, m in due[:GROUP_SEND_QUOTA]:
+        # a broadcast may overshoot limit, otherwise a big one would be deferred forever
+        if len(group["outbox"]) - before >= limit:
+            break
+        try:
+            # send once
+            text = f"Nhắc nhở: {m.get('message','')}\n"
+            recipients = get_recipients(group, m)
+            if recipients is None:
+                group["outbox"].append({"id": m["id"], "chat_id": chat_id, "text": text, "at": fired_at})
+            else:
+                delivery: Dict[str, Dict[str, str]] = {}
+                for cid in recipients:
+                    # re-checked at fire time: the target may have revoked its opt-in
+                    if groups.accepts_broadcast(cid, chat_id):
+                        group["outbox"].append({"id": m["id"], "chat_id": cid, "text": text,
+                                                "at": fired_at, "broadcast": True})
+                        delivery[str(cid)] = {"status": "pending", "at": fired_at}
+                    else:
+                        delivery[str(cid)] = {"status": "skipped", "at": fired_at,
+                                              "error": "chat chưa /start, đã pause_all hoặc không cho phép"}
+                m["delivery"] = delivery
+
+            # reschedule (catch-up)
+            duration_days = int(m["duration"])
+            next_time = due_time
+            while next_time <= now:
+                next_time += timedelta(days=duration_days)
+            m["time_receive"] = timestr_from_aware(next_time, tz)
 
-            tz = get_tz(g["settings"]["tz"])
-            now = dt.datetime.now(tz)
+        except Exception as e:
+            logging.info("enqueue error: %s", e)
 
-            # copy list for iteration
-            data_list = list(g.get("data", []))
+    return len(group["outbox"]) - before
+
+
+def classify_send_error(e: Exception) -> str:
+    """'failed' if retrying cannot help (bot blocked/kicked, bad chat), else 'retry'."""
+    if isinstance(e, (Forbidden, BadRequest)):
+        return "failed"
+    return "retry"
 
-            for m in data_list:
-                try:
-                    if not m.get("enabled", True):
-                        continue
 
-                    due_time = aware_from_timestr(m["time_receive"], tz)
-                    if due_time > now:
+def apply_send_result(owner_id: int, g: Optional[Dict[str, Any]], entry: Dict[str, Any], status: str,
+                      err: Optional[str], retry_after: Optional[float] = None) -> Optional[str]:
+    """
+    Record the outcome of one outbox entry (matched by outbox_key) in the owner group g.
+    Caller holds the owner group's lock. retry_after (flood control) requeues the entry
+    without counting an attempt.
+    Returns the final status ("sent"/"failed") if the entry left the outbox, else None.
+    """
+    if not g:
+        return None
+    key = outbox_key(entry)
+    pos = next((i for i, e in enumerate(g["outbox"]) if outbox_key(e) == key), None)
+    if pos is None:
+        return None
+    entry = g["outbox"][pos]
+    groups.mark_dirty(owner_id)
+
+    if retry_after is not None:
+        g["outbox"][pos] = dict(entry, retry_at=time.time() + retry_after)
+        return None
+
+    if status == "retry":
+        attempts = int(entry.get("attempts", 0)) + 1
+        if attempts < SEND_MAX_ATTEMPTS:
+            backoff = min(10 * 2 ** attempts, 3600)
+            g["outbox"][pos] = dict(entry, attempts=attempts, retry_at=time.time() + backoff)
+            logging.info("send retry %s in %ss (attempt %d): %s", entry["chat_id"], backoff, attempts, err)
+            return None
+        status = "failed"
+
+    del g["outbox"][pos]
+    if not entry.get("broadcast"):
+        if err:
+            logging.info("send error %s: %s", entry["chat_id"], err)
+        return status
+    for m in g["data"]:
+        if int(m.get("id")) == int(entry["id"]):
+            st = {"status": status, "at": entry["at"]}
+            if err:
+                st["error"] = err
+            m.setdefault("delivery", {})[str(entry["chat_id"])] = st
+            break
+    return status
+
+
+async def replay_outbox_journal() -> None:
+    """Apply sends journaled after the last save (killed mid-drain), then drop the journal."""
+    if not os.path.exists(OUTBOX_JOURNAL):
+        return
+    applied = 0
+    with open(OUTBOX_JOURNAL, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+                owner_id = int(rec["owner"])
+                entry_id, chat_id, at = rec["key"]
+                async with groups.lock(owner_id):
+                    g = await groups.fetch(owner_id)
+                    if apply_send_result(owner_id, g, {"id": entry_id, "chat_id": chat_id, "at": at},
+                                         rec["status"], rec.get("error")):
+                        applied += 1
+            except Exception as e:
+                # a torn last line from the kill
+                logging.info("journal replay error: %s", e)
+    await save_data()
+    clear_journal()
+    if applied:
+        logging.warning("Replayed %d finished sends from %s", applied, OUTBOX_JOURNAL)
+
+
+async def drain_outbox(bot: Bot) -> None:
+    """
+    Send this tick's share of the outbox: up to GROUP_SEND_QUOTA entries per destination
+    chat, sequential within a chat, concurrent across chats. Finished sends are journaled
+    as they complete; the groups are saved once at the end.
+    """
+    now_ts = time.time()
+    queues: Dict[int, List[Tuple[int, Dict[str, Any]]]] = {}
+    for owner_id in rotate(groups.outbox_ids(), rr_offset):
+        try:
+            async with groups.lock(owner_id):
+                g = await groups.fetch(owner_id)
+                if not g:
+                    continue
+                for entry in g["outbox"]:
+                    if entry.get("retry_at", 0) > now_ts:
                         continue
+                    queue = queues.setdefault(int(entry["chat_id"]), [])
+                    if len(queue) < GROUP_SEND_QUOTA:
+                        queue.append((owner_id, entry))
+        except OSError as e:
+            logging.error("Outbox of %s unreadable: %s", owner_id, e)
+    if not queues:
+        return
 
-                    # send once
-                    text = f"Nhắc nhở: {m.get('message','')}\n"
-                    await context.bot.send_message(chat_id=chat_id, text=text)
-
-                    # reschedule (catch-up)
-                    duration_days = int(m["duration"])
-                    next_time = due_time
-                    while next_time <= now:
-                        next_time += timedelta(days=duration_days)
-
-                    # write back
-                    async with data_lock:
-                        gg = groups.get(chat_id)
-                        if not gg:
-                            continue
-                        ensure_group_defaults(gg)
-                        for mm in gg["data"]:
-                            if int(mm.get("id")) == int(m.get("id")):
-                                mm["time_receive"] = timestr_from_aware(next_time, tz)
-                                changed = True
-                                break
+    loop = asyncio.get_running_loop()
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    journal_lock = asyncio.Lock()
+    journal: List[str] = []
+    done = 0
+    sent = 0
+
+    async def _flush() -> None:
+        async with journal_lock:
+            lines = journal[:]
+            journal.clear()
+            if lines:
+                await loop.run_in_executor(None, append_journal, lines)
+
+    async def _chat(chat_id: int, queue: List[Tuple[int, Dict[str, Any]]]) -> None:
+        nonlocal done, sent
+        async with sem:
+            for owner_id, entry in queue:
+                retry_after = None
+                try:
+                    await send_routed(bot, chat_id, entry["text"])
+                    status, err = "sent", None
+                except RetryAfter as e:
+                    retry_after = retry_seconds(e)
+                    status, err = "retry", str(e)
+                except Exception as e:
+                    status, err = classify_send_error(e), str(e)
 
+                # never let one worker abort the drain while the others keep sending
+                try:
+                    async with groups.lock(owner_id):
+                        g = await groups.fetch(owner_id)
+                        final = apply_send_result(owner_id, g, entry, status, err, retry_after)
+                    if final:
+                        journal.append(json.dumps({"owner": owner_id, "key": list(outbox_key(entry)),
+                                                   "status": final, "error": err}) + "\n")
+                        if len(journal) >= OUTBOX_JOURNAL_EVERY:
+                            await _flush()
                 except Exception as e:
-                    logging.info("send loop error: %s", e)
+                    logging.exception("outbox result error %s: %s", chat_id, e)
+                done += 1
+                sent += status == "sent"
+                if retry_after is not None:
+                    # flood-limited in this chat: the rest waits for a later tick
+                    break
 
-        except Exception as e:
-            logging.info("group loop error: %s", e)
+    await asyncio.gather(*(_chat(chat_id, queue) for chat_id, queue in queues.items()))
+    logging.info("Outbox drained: %d/%d sent", sent, done)
+    try:
+        await _flush()
+    except Exception as e:
+        logging.error("Outbox journal write error: %s", e)
+    # one save for the whole drain; after it the journal is redundant
+    await save_data()
+    await loop.run_in_executor(None, clear_journal)
 
-    if changed:
+
+async def send_due_messages(context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not accepting_fires:
+        return
+
+    global rr_offset
+    async with sender_lock:
+        # only groups the index says are due are loaded
+        deferred = 0
+        for chat_id in rotate(groups.due_ids(time.time()), rr_offset):
+            try:
+                async with groups.lock(chat_id):
+                    g = await groups.fetch(chat_id)
+                    if not g:
+                        continue
+                    # admission control per group: a flooded or huge broadcast of one
+                    # group does not hold back the fires of the others
+                    limit = SEND_BACKLOG_LIMIT - len(g["outbox"])
+                    if limit <= 0:
+                        deferred += 1
+                        continue
+                    enqueue_due(chat_id, g, limit)
+            except Exception as e:
+                logging.info("group loop error: %s", e)
+        if deferred:
+            logging.warning("%d groups have >= %d sends waiting, deferring their new fires",
+                            deferred, SEND_BACKLOG_LIMIT)
+
+        # write-ahead: reschedule + pending sends are on disk before the first send
+        # (no-op if nothing is dirty)
         await save_data()
 
+        await drain_outbox(context.bot)
+
+        rr_offset += 1
+
+
+def ensure_send_job(job_queue: Any) -> None:
+    exists = any(j.name == "auto_send" for j in job_queue.jobs())
+    if not exists:
+        job_queue.run_repeating(send_due_messages, name="auto_send", interval=10, first=0)
+
 
 # -----------------------------
 # Main
 # -----------------------------
 async def on_startup(app: Application) -> None:
     await load_data()
+    await replay_outbox_journal()
+    await init_senders()
+    # resume right away: a leftover outbox from the previous process is drained on the first tick
+    ensure_send_job(app.job_queue)
+
+
+async def on_stop(app: Application) -> None:
+    # post_stop (not post_shutdown): the bot is still usable here, so in-flight sends can finish
+    global accepting_fires
+    accepting_fires = False
+    async with sender_lock:
+        pass
+    await save_data()
+    logging.info("Stopped: in-flight sends finished, data flushed")
+
+
+async def on_shutdown(app: Application) -> None:
+    await shutdown_senders()
 
 
 def main() -> None:
-    app = Application.builder().token(TOKEN).post_init(on_startup).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(on_startup)
+        .post_stop(on_stop)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler(["start", "help"], start))
     app.add_handler(CommandHandler("set_message", set_message))
@@ -733,6 +1743,10 @@ def main() -> None:
     app.add_handler(CommandHandler("resume_all", resume_all))
     app.add_handler(CommandHandler("set_timezone", set_timezone))
     app.add_handler(CommandHandler("export", export_data))
+    app.add_handler(CommandHandler("set_chat_set", set_chat_set))
+    app.add_handler(CommandHandler("broadcast_status", broadcast_status))
+    app.add_handler(CommandHandler("allow_broadcast", allow_broadcast))
+    app.add_handler(CommandHandler("deny_broadcast", deny_broadcast))
 
     app.run_polling()
 